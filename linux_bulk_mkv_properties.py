@@ -10,6 +10,7 @@ Command Line Parameters:  There is just 1:
                           It is the folder path that will be used to start looking at the *.mkv files from.
                           If this value isn't provided, then the starting path will be where this application file is located.
                           The intention is that you can call this application from a context menu from a file browser (e.g. Nemo) and it would automatically load up that folder.
+                          Run with "--help" for the optional (headless) options, e.g. "--export-snapshot".
 Purpose:  I couldn't find a good tool for bulk changing the default flag on audio and subtitle tracks in mkv files on **Linux**, so I decided to make my own.
           While I made the Linux Bulk MKV Edit (https://github.com/BSFEMA/linux_bulk_mkv_properties) to remove audio & subtitle tracks,
           I have run into situations where I just want to set the default audio & subtitle tracks without making any 'real' changes.
@@ -25,6 +26,7 @@ import gi
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk as gtk
 from gi.repository import Gdk as gdk
+from gi.repository import GLib as glib
 import sys
 import os
 import re
@@ -32,6 +34,23 @@ import datetime
 from operator import itemgetter
 import subprocess
 import json
+import hashlib
+import html
+import functools
+import asyncio
+import threading
+import errno
+import collections
+import gzip
+import io
+import argparse
+import multiprocessing
+import shlex
+import time
+try:
+    import zstandard  # Optional:  only needed to read/write *.zst snapshots
+except ImportError:
+    zstandard = None
 
 
 default_folder_path = ""  # The path for the filechooser and data grid to work against.  This is the base folder to work against.
@@ -46,7 +65,26 @@ types_subtitle = []  # Holds the unique subtitle types (codex)
 ids_subtitle = []  # Holds the unique subtitle ids
 command_lines = {}  # The full list of command lines, or the output of this application
 output = ""  # The output of the command lines
+plans = {}  # The expected state of each file (full path) once its command line has been run, used to verify the results
+verify_results = {}  # The mismatches (full path: [problems]) found by the last verification pass
 multi_lines = False
+group_layouts = False  # Show one data grid row per track layout instead of one per file
+probe_workers = 16  # How many mkv files the streaming pipeline reads (mkvmerge --identify) ahead of the later stages
+parameter_files = []  # The files passed on the command line (e.g. from Nemo)
+snapshot_columns = ["file", "title", "track_id", "kind", "language", "codec", "name", "default"]  # One snapshot row per track
+plan_columns = ["file", "title", "tracks", "defaults", "impact"]  # One plan row per file (full path)
+result_columns = ["file", "returncode", "problems"]  # One apply result row per file (full path)
+process_options = {"max_processes": 8, "timeout": 120, "retries": 2, "backoff": 1.0}  # The global cap on concurrent child processes (mkvmerge/mkvpropedit), the per call timeout (seconds), and the retries (with exponential backoff) for transient I/O errors
+process_loop = None  # The asyncio event loop (in its own thread) that runs every child process, see run_process
+process_semaphore = None  # Enforces process_options["max_processes"] inside process_loop
+apply_options = {"ionice": "", "nice": 0, "rate_files": 0.0, "rate_mb": 0.0}  # How gently to apply the plans:  I/O priority class ("", "best-effort" or "idle"), CPU nice, and rate limits in files/MB per second (0 = no limit)
+profiles_path = os.path.join(os.environ.get("XDG_CONFIG_HOME", os.path.expanduser("~/.config")), "linux_bulk_mkv_properties", "profiles.json")  # The saved rule profiles
+throughput_path = os.path.join(os.path.dirname(profiles_path), "throughput.json")  # The measured apply times of earlier runs, by impact
+impact_bytes = {"unchanged": 0, "flags": 4096, "title": 65536}  # Rough constants of the bytes written per file, not measurements:  mkvpropedit writes an element in place when it still fits and moves it otherwise, and doesn't say which it did
+default_seconds_per_file = {"unchanged": 0.1, "flags": 0.2, "title": 0.5, "verify": 0.1}  # Used until there are measured apply (and verify) times
+impact_names = {"unchanged": "already as planned", "flags": "default flag change", "title": "title change"}  # Shown next to each file of the output
+legacy_impacts = {"flag": "flags", "rewrite": "title"}  # The impact names of older plan files
+apply_timings = {}  # The apply times (impact: [files, seconds]) of the current run, added to throughput_path at the end of the run
 
 
 class Main():
@@ -91,6 +129,14 @@ class Main():
         # (1,1) = Right, Botton
         cellrenderer_Subtitles.set_alignment(0, 0)
         cellrenderer_Audio.set_alignment(0, 0)
+        # Render the Audio and Subtitles columns from the (memoized) track tuples, instead of storing the markup of every row in the liststore
+        self.grid_sources = []  # The files_Full entry of each data grid row, by the row's (hidden) Source column
+        treeviewcolumn_Audio = self.builder.get_object("treeviewcolumn_Audio")
+        treeviewcolumn_Audio.clear_attributes(cellrenderer_Audio)
+        treeviewcolumn_Audio.set_cell_data_func(cellrenderer_Audio, self.render_cell, 2)
+        treeviewcolumn_Subtitles = self.builder.get_object("treeviewcolumn_Subtitles")
+        treeviewcolumn_Subtitles.clear_attributes(cellrenderer_Subtitles)
+        treeviewcolumn_Subtitles.set_cell_data_func(cellrenderer_Subtitles, self.render_cell, 3)
         # Set the button_Process image
         button_Process = self.builder.get_object("button_Process")
         button_Process.set_always_show_image(True)
@@ -103,6 +149,8 @@ class Main():
         combo_Title_Keep = self.builder.get_object("combo_Title_Keep")
         combo_Title_Keep.set_entry_text_column(0)
         combo_Title_Keep.set_active(1)
+        # Fill combo_Profile with the saved rule profiles
+        self.update_profile_names()
         # Set initial_load to False as the application settings should now be setup correctly
         self.initial_load = False
         self.repaint_GUI()  # Make sure GUI is up to date
@@ -237,13 +285,22 @@ class Main():
         global multi_lines
         button_Multi = self.builder.get_object("button_Multi")
         multi_lines = button_Multi.get_active()
-        populate_files_Full()
-        self.button_Refresh_clicked(self)
+        # Only the rendering changes, so there is no need to read the files again
+        self.load_Data_Grid()
+        self.resize_column_widths()
+
+    def button_Group_toggled(self, widget):
+        global group_layouts
+        group_layouts = self.builder.get_object("button_Group").get_active()
+        self.load_Data_Grid()
+        self.resize_column_widths()
 
     def button_Process_clicked(self, widget):
         global default_folder_path
         global files_Full
         global command_lines
+        global plans
+        global verify_results
         combo_Title_Keep = self.builder.get_object("combo_Title_Keep")
         entry_Audio_Languages = self.builder.get_object("entry_Audio_Languages")
         entry_Audio_Name = self.builder.get_object("entry_Audio_Name")
@@ -255,6 +312,19 @@ class Main():
         entry_IDs_Subtitles = self.builder.get_object("entry_IDs_Subtitles")
         command_lines.clear()
         command_lines = {}
+        plans.clear()
+        verify_results.clear()
+        # With 'Use profile', the selected rule profile is evaluated the same way as with --profile (including its fallback rules) instead of the options
+        if self.builder.get_object("button_Use_Profile").get_active():
+            profile = self.get_selected_profile()
+            if profile is None:
+                return
+            plan_profile(profile)
+            for file in files_Full:
+                file_path = default_folder_path + "/" + str(file[0])
+                command_lines[file[0]] = shlex.join(build_mkvpropedit_command(file_path, plans[file_path]))
+            self.dialog_Results(self)
+            return
         ################################################################################
         # Clear up input
         # Title
@@ -340,6 +410,7 @@ class Main():
         # files_Full[9] = (audio tracks) {}
         # files_Full[10] = (subtitle tracks) {}
         # Build list of Track IDs to keep
+        rule_results = {}  # (keep_audio, keep_subtitle) by track layout
         for i in range(len(files_Full)):
             # Make list of all Audio and Subtitle tracks
             audio_and_subtitles = []
@@ -347,63 +418,68 @@ class Main():
                 audio_and_subtitles.append(track)
             for track in files_Full[i][10]:
                 audio_and_subtitles.append(track)
-            # Make a temp copy of the file, then start removing the various tracks
-            keep_audio = []
-            keep_subtitle = []
-            # Audio Languages
-            temp_audio = []
-            for track in files_Full[i][9]:
-                if files_Full[i][9][track]["track_lang"] in str(al):
-                    temp_audio.append(track)
-            keep_audio = keep_audio + temp_audio
-            # Audio Name
-            if len(an) > 0:
-                temp_audio = []
-                for track in files_Full[i][9]:
-                    if str(an).upper() in files_Full[i][9][track]["track_name"].upper():
-                        temp_audio.append(track)
-                keep_audio = keep_audio + temp_audio
-            # Audio Type
-            if len(at) > 0:
+            # Files with the same track layout get the same result, so the rules only need to be evaluated once per layout
+            layout = files_Full[i][5]
+            if layout not in rule_results:
+                # Make a temp copy of the file, then start removing the various tracks
+                keep_audio = []
+                keep_subtitle = []
+                # Audio Languages
                 temp_audio = []
                 for track in files_Full[i][9]:
-                    if str(at).upper() in files_Full[i][9][track]["track_type"].upper():
-                        temp_audio.append(track)
-                keep_audio = temp_audio
-            # Audio IDs
-            if len(ai) > 0:
-                temp_audio = []
-                for track in ai:
-                    if str(track) in ids_audio:
+                    if files_Full[i][9][track]["track_lang"] in str(al):
                         temp_audio.append(track)
                 keep_audio = keep_audio + temp_audio
-            # Subtitle Languages
-            temp_subtitle = []
-            for track in files_Full[i][10]:
-                if files_Full[i][10][track]["track_lang"] in str(sl):
-                    temp_subtitle.append(track)
-            keep_subtitle = keep_subtitle + temp_subtitle
-            # Subtitle Name
-            if len(sn) > 0:
+                # Audio Name
+                if len(an) > 0:
+                    temp_audio = []
+                    for track in files_Full[i][9]:
+                        if str(an).upper() in files_Full[i][9][track]["track_name"].upper():
+                            temp_audio.append(track)
+                    keep_audio = keep_audio + temp_audio
+                # Audio Type
+                if len(at) > 0:
+                    temp_audio = []
+                    for track in files_Full[i][9]:
+                        if str(at).upper() in files_Full[i][9][track]["track_type"].upper():
+                            temp_audio.append(track)
+                    keep_audio = temp_audio
+                # Audio IDs
+                if len(ai) > 0:
+                    temp_audio = []
+                    for track in ai:
+                        if str(track) in ids_audio:
+                            temp_audio.append(track)
+                    keep_audio = keep_audio + temp_audio
+                # Subtitle Languages
                 temp_subtitle = []
                 for track in files_Full[i][10]:
-                    if str(sn).upper() in files_Full[i][10][track]["track_name"].upper():
-                        temp_subtitle.append(track)
-                keep_subtitle = keep_subtitle + temp_subtitle
-            # Subtitle Type
-            if len(st) > 0:
-                temp_subtitle = []
-                for track in files_Full[i][10]:
-                    if str(st).upper() in files_Full[i][10][track]["track_type"].upper():
-                        temp_subtitle.append(track)
-                keep_subtitle = keep_subtitle + temp_subtitle
-            # Subtitle IDs
-            if len(si) > 0:
-                temp_subtitle = []
-                for track in si:
-                    if str(track) in ids_subtitle:
+                    if files_Full[i][10][track]["track_lang"] in str(sl):
                         temp_subtitle.append(track)
                 keep_subtitle = keep_subtitle + temp_subtitle
+                # Subtitle Name
+                if len(sn) > 0:
+                    temp_subtitle = []
+                    for track in files_Full[i][10]:
+                        if str(sn).upper() in files_Full[i][10][track]["track_name"].upper():
+                            temp_subtitle.append(track)
+                    keep_subtitle = keep_subtitle + temp_subtitle
+                # Subtitle Type
+                if len(st) > 0:
+                    temp_subtitle = []
+                    for track in files_Full[i][10]:
+                        if str(st).upper() in files_Full[i][10][track]["track_type"].upper():
+                            temp_subtitle.append(track)
+                    keep_subtitle = keep_subtitle + temp_subtitle
+                # Subtitle IDs
+                if len(si) > 0:
+                    temp_subtitle = []
+                    for track in si:
+                        if str(track) in ids_subtitle:
+                            temp_subtitle.append(track)
+                    keep_subtitle = keep_subtitle + temp_subtitle
+                rule_results[layout] = (keep_audio, keep_subtitle)
+            keep_audio, keep_subtitle = rule_results[layout]
             ################################################################################
             # Build the track options based on the remaining tracks
             """
@@ -418,29 +494,33 @@ class Main():
             --edit track:2 --set flag-default=1
             Note: Since tracks are zero based, need to use (track_ID + 1)
             """
-            command = "/usr/bin/mkvpropedit '" + str(files_Full[i][0]) + "' --edit info "
+            # Remember what the file should look like afterwards, so that it can be verified later on
             if mkv_title == 1:
-                command = command + "--set \"title=\" "
-            # Set all to NOT default
-            for track in audio_and_subtitles:
-                command = command + "--edit track:" + str(int(track) + 1) + " --set flag-default=0 "
-            # Set Default Audio Tracks
-            for track in keep_audio:
-                command = command + "--edit track:" + str(int(track) + 1) + " --set flag-default=1 "
-            # Set Default Subtitle Tracks
-            for track in keep_subtitle:
-                command = command + "--edit track:" + str(int(track) + 1) + " --set flag-default=1 "
-            command_lines[files_Full[i][0]] = command
+                plan_title = ""
+            else:
+                plan_title = None  # The title isn't touched
+            plan_defaults = []
+            for track in keep_audio + keep_subtitle:
+                if int(track) not in plan_defaults and str(track) in [str(track_id) for track_id in audio_and_subtitles]:  # Entered track IDs that this file doesn't have are left out
+                    plan_defaults.append(int(track))
+            plan_defaults.sort()
+            file_path = default_folder_path + "/" + str(files_Full[i][0])
+            plans[file_path] = {"title": plan_title, "tracks": [int(track) for track in audio_and_subtitles], "defaults": plan_defaults}
+            plans[file_path]["impact"] = get_plan_impact(plans[file_path], files_Full[i][1], files_Full[i][11])
+            # The command line is built from the plan, so that what is shown is exactly what Apply Now (or --apply-plan) runs
+            command_lines[files_Full[i][0]] = shlex.join(build_mkvpropedit_command(file_path, plans[file_path]))
         # print(str(command_lines))
         self.dialog_Results(self)
 
     def dialog_Results(self, widget):  # Creates the "Results" dialog that displays the command line
         global command_lines
         global output
-        # Make output
+        # Make output, starting with the estimated impact (as comments, so that the output can still be pasted into a terminal)
         output = ""
+        for line in format_impact(estimate_impact(list(plans.keys()), parallel_verify=True)):
+            output = output + "# " + line + "\n"
         for command in command_lines:
-            output = output + "# " + str(command) + "\n"
+            output = output + "# " + str(command) + get_impact_comment(plans.get(default_folder_path + "/" + str(command))) + "\n"
             output = output + str(command_lines[command]) + "\n"
         # Create Dialog
         dialog = gtk.Dialog(title="Command Lines", parent=None)
@@ -451,6 +531,32 @@ class Main():
         # Add a 'copy to clipboard' button
         button_copy_to_clipboard = gtk.Button(label="Copy output to Clipboard")
         button_copy_to_clipboard.connect("clicked", self.copy_output_to_clipboard)
+        # Add a 'save plan' button, the plan file can be applied headless (e.g. per shard with --manifest)
+        button_save_plan = gtk.Button(label="Save Plan")
+        button_save_plan.connect("clicked", self.button_Save_Plan_clicked)
+        # Add the 'apply now' options and button, so that the plans can be run (gently) from here instead of a terminal
+        box_apply = gtk.Box(spacing=6)
+        box_apply.add(gtk.Label(label="I/O Priority:"))
+        self.combo_Apply_IOnice = gtk.ComboBoxText()
+        for ionice_class in ["Normal", "Best-effort (lowest)", "Idle"]:
+            self.combo_Apply_IOnice.append_text(ionice_class)
+        self.combo_Apply_IOnice.set_active(["", "best-effort", "idle"].index(apply_options["ionice"]))
+        box_apply.add(self.combo_Apply_IOnice)
+        box_apply.add(gtk.Label(label="CPU Nice:"))
+        self.spin_Apply_Nice = gtk.SpinButton.new_with_range(0, 19, 1)
+        self.spin_Apply_Nice.set_value(apply_options["nice"])
+        box_apply.add(self.spin_Apply_Nice)
+        box_apply.add(gtk.Label(label="Max Files/s (0 = no limit):"))
+        self.spin_Apply_Rate_Files = gtk.SpinButton.new_with_range(0, 1000, 0.5)
+        self.spin_Apply_Rate_Files.set_value(apply_options["rate_files"])
+        box_apply.add(self.spin_Apply_Rate_Files)
+        box_apply.add(gtk.Label(label="Max MB/s written (0 = no limit):"))
+        self.spin_Apply_Rate_MB = gtk.SpinButton.new_with_range(0, 10000, 1)
+        self.spin_Apply_Rate_MB.set_value(apply_options["rate_mb"])
+        box_apply.add(self.spin_Apply_Rate_MB)
+        button_apply_now = gtk.Button(label="Apply Now")
+        button_apply_now.connect("clicked", self.button_Apply_Now_clicked)
+        box_apply.pack_end(button_apply_now, False, True, 0)
         # Create textview
         dialog.textview = gtk.TextView()
         textbuffer = dialog.textview.get_buffer()
@@ -463,11 +569,93 @@ class Main():
         scrolledwindow.add(dialog.textview)
         area.add(scrolledwindow)
         area.add(button_copy_to_clipboard)
+        area.add(button_save_plan)
+        area.add(box_apply)
         # Display the dialog
         dialog.show_all()
         dialog.run()
         dialog.destroy()
 
+    def button_Apply_Now_clicked(self, widget):  # Runs the plans with the chosen priority/rate options in the background, then verifies the results
+        global plans
+        apply_options["ionice"] = ["", "best-effort", "idle"][self.combo_Apply_IOnice.get_active()]
+        apply_options["nice"] = int(self.spin_Apply_Nice.get_value())
+        apply_options["rate_files"] = self.spin_Apply_Rate_Files.get_value()
+        apply_options["rate_mb"] = self.spin_Apply_Rate_MB.get_value()
+        widget.set_sensitive(False)  # Only one apply job at a time
+        file_paths = order_for_locality(list(plans.keys()))
+        self.apply_cancel = threading.Event()
+        # Show the progress, with a way to stop before the rest of the files
+        self.dialog_apply = gtk.Dialog(title="Apply Now", parent=widget.get_toplevel())
+        self.dialog_apply.set_modal(True)
+        self.dialog_apply.set_default_size(400, -1)
+        self.dialog_apply.add_buttons(gtk.STOCK_CANCEL, gtk.ResponseType.CANCEL)
+        self.dialog_apply.connect("response", self.dialog_Apply_cancel)
+        self.dialog_apply.connect("delete-event", self.dialog_Apply_cancel)
+        self.progressbar_apply = gtk.ProgressBar()
+        self.progressbar_apply.set_show_text(True)
+        self.progressbar_apply.set_text("0 of " + str(len(file_paths)) + " files")
+        self.dialog_apply.get_content_area().add(self.progressbar_apply)
+        self.dialog_apply.show_all()
+        threading.Thread(target=self.apply_in_background, args=(file_paths, widget), name="apply", daemon=True).start()
+
+    def apply_in_background(self, file_paths, widget):  # Runs on its own thread, so the GUI (and files_Full) only get updated through glib.idle_add
+        results = []
+        problems = {}
+        json_datas = {}
+        error = None
+        try:
+            results = apply_plans(file_paths, verify=False, cancel=self.apply_cancel, progress=lambda done, total: glib.idle_add(self.update_apply_progress, done, total))
+            problems, json_datas = check_plans([row[0] for row in results])  # Re-read the edited files (in parallel) to check them
+        except Exception as exception:  # Reported by apply_finished, so that the dialog doesn't stay open
+            error = exception
+        finally:
+            glib.idle_add(self.apply_finished, results, problems, json_datas, len(file_paths), widget, error)
+
+    def dialog_Apply_cancel(self, *args):  # Stops after the file that is being applied, the dialog stays open until then
+        self.apply_cancel.set()
+        self.progressbar_apply.set_text("Stopping after the current file...")
+        return True
+
+    def update_apply_progress(self, done, total):
+        if not self.apply_cancel.is_set():
+            self.progressbar_apply.set_fraction(done / total)
+            self.progressbar_apply.set_text(str(done) + " of " + str(total) + " files")
+        return False  # Only run once
+
+    def apply_finished(self, results, problems, json_datas, total, widget, error):
+        global verify_results
+        verify_results.clear()
+        verify_results.update(problems)
+        update_files_Full(json_datas)  # Update the data grid with what was just read
+        for row in results:
+            if row[1] not in [0, 1]:  # Keep the mkvpropedit errors (2), and the timeouts or commands that couldn't run (-1)
+                verify_results[row[0]] = row[2] + verify_results.get(row[0], [])
+        self.dialog_apply.destroy()
+        widget.set_sensitive(True)
+        self.load_Data_Grid()
+        self.resize_column_widths()
+        mismatches = 0
+        for file_path in verify_results:
+            if len(verify_results[file_path]) > 0:
+                mismatches = mismatches + 1
+        message = "Applied " + str(len(results)) + " files:  " + str(len(results) - mismatches) + " OK, " + str(mismatches) + " don't match the plan (marked in red in the data grid)."
+        if error is not None:
+            message = "Applied " + str(len(results)) + " of " + str(total) + " files, then stopped by an error (the files weren't verified, use Verify Changes):  " + str(error)
+        elif len(results) < total:
+            message = message + "  Cancelled, " + str(total - len(results)) + " files were not applied."
+        self.dialog_Message("Apply Now", message)
+        return False  # Only run once
+
+    def button_Save_Plan_clicked(self, widget):  # Saves the plans, so they can be applied with --apply-plan
+        dialog = gtk.FileChooserDialog(title="Save Plan", parent=None, action=gtk.FileChooserAction.SAVE)
+        dialog.add_buttons(gtk.STOCK_CANCEL, gtk.ResponseType.CANCEL, gtk.STOCK_SAVE, gtk.ResponseType.OK)
+        dialog.set_do_overwrite_confirmation(True)
+        dialog.set_current_name(os.path.basename(default_folder_path) + ".plan.jsonl")
+        if dialog.run() == gtk.ResponseType.OK:
+            save_plan(dialog.get_filename())
+        dialog.destroy()
+
     def copy_output_to_clipboard(self, widget):
         global output
         self.clipboard = gtk.Clipboard.get(gdk.SELECTION_CLIPBOARD)
@@ -488,6 +676,157 @@ class Main():
         window.get_window().set_cursor(None)  # Set curror back to 'None'
         self.repaint_GUI()  # Make sure GUI is up to date
 
+    def button_Verify_clicked(self, widget):  # Re-reads the headers of the edited files and compares them with what was planned
+        global plans
+        global verify_results
+        if len(plans) == 0:
+            self.dialog_Message("Verify Changes", "There is nothing to verify yet.  Click 'Process Files' and run the command lines first.")
+            return
+        self.repaint_GUI()  # Make sure GUI is up to date
+        window = self.builder.get_object("main_Window")
+        watch_cursor = gdk.Cursor(gdk.CursorType.WATCH)
+        window.get_window().set_cursor(watch_cursor)  # Set curror to 'Waiting'
+        self.repaint_GUI()  # Make sure GUI is up to date
+        verify_plans()
+        self.load_Data_Grid()
+        self.resize_column_widths()
+        self.repaint_GUI()  # Make sure GUI is up to date
+        window.get_window().set_cursor(None)  # Set curror back to 'None'
+        self.repaint_GUI()  # Make sure GUI is up to date
+        mismatches = 0
+        for file_path in verify_results:
+            if len(verify_results[file_path]) > 0:
+                mismatches = mismatches + 1
+        if mismatches == 0:
+            self.dialog_Message("Verify Changes", "All " + str(len(verify_results)) + " files match the plan.")
+        else:
+            self.dialog_Message("Verify Changes", str(mismatches) + " of " + str(len(verify_results)) + " files don't match the plan.  They are marked in red in the data grid.")
+
+    def dialog_Message(self, title, message):  # Creates a simple dialog that displays a message
+        dialog = gtk.MessageDialog(parent=self.builder.get_object("main_Window"), modal=True, message_type=gtk.MessageType.INFO, buttons=gtk.ButtonsType.OK, text=title)
+        dialog.format_secondary_text(message)
+        dialog.run()
+        dialog.destroy()
+
+    def button_Export_Snapshot_clicked(self, widget):  # Saves the scanned file information so it can be reviewed elsewhere
+        dialog = gtk.FileChooserDialog(title="Export Snapshot", parent=self.builder.get_object("main_Window"), action=gtk.FileChooserAction.SAVE)
+        dialog.add_buttons(gtk.STOCK_CANCEL, gtk.ResponseType.CANCEL, gtk.STOCK_SAVE, gtk.ResponseType.OK)
+        dialog.set_do_overwrite_confirmation(True)
+        dialog.set_current_name(os.path.basename(default_folder_path) + ".jsonl.gz")
+        if dialog.run() == gtk.ResponseType.OK:
+            export_snapshot(dialog.get_filename())
+        dialog.destroy()
+
+    def button_Import_Snapshot_clicked(self, widget):  # Loads previously scanned file information instead of reading the mkv files
+        global default_folder_path
+        dialog = gtk.FileChooserDialog(title="Import Snapshot", parent=self.builder.get_object("main_Window"), action=gtk.FileChooserAction.OPEN)
+        dialog.add_buttons(gtk.STOCK_CANCEL, gtk.ResponseType.CANCEL, gtk.STOCK_OPEN, gtk.ResponseType.OK)
+        if dialog.run() == gtk.ResponseType.OK:
+            snapshot_path = dialog.get_filename()
+            dialog.destroy()
+            self.load_snapshot(snapshot_path)
+        else:
+            dialog.destroy()
+
+    def load_snapshot(self, snapshot_path):  # Replaces the data grid with the contents of a snapshot
+        self.clear_Data_Grid()
+        import_snapshot(snapshot_path)
+        # Show the snapshot's folder without re-scanning it (it might not even exist on this machine)
+        self.initial_load = True
+        entry_Folder_path = self.builder.get_object("entry_Folder_path")
+        entry_Folder_path.set_text(default_folder_path)
+        self.initial_load = False
+        self.load_Data_Grid()
+        self.resize_column_widths()
+        self.update_lables()
+
+    def get_profiles(self):  # Reads the saved rule profiles, showing the error (instead of crashing) if the profiles file is broken, e.g. by a hand edit
+        try:
+            return load_profiles()
+        except (ValueError, OSError) as error:
+            self.dialog_Message("Rule Profile", "Could not read " + profiles_path + ":  " + str(error))
+            return None
+
+    def get_entry_rules(self):  # Gets the option entries as the first rules of a profile:  (audio rule, subtitle rule, keep title)
+        audio_rule = {"languages": self.builder.get_object("entry_Audio_Languages").get_text().strip(),
+                      "name": self.builder.get_object("entry_Audio_Name").get_text().strip(),
+                      "types": self.builder.get_object("entry_Audio_Types").get_text().strip(),
+                      "ids": self.builder.get_object("entry_IDs_Audio").get_text().strip()}
+        subtitle_rule = {"languages": self.builder.get_object("entry_Subtitles_Languages").get_text().strip(),
+                         "name": self.builder.get_object("entry_Subtitles_Name").get_text().strip(),
+                         "types": self.builder.get_object("entry_Subtitles_Types").get_text().strip(),
+                         "ids": self.builder.get_object("entry_IDs_Subtitles").get_text().strip()}
+        return audio_rule, subtitle_rule, self.builder.get_object("combo_Title_Keep").get_active() == 0
+
+    def get_selected_profile(self):  # Gets the saved profile named in combo_Profile, or shows why there isn't one
+        name = self.builder.get_object("combo_Profile").get_child().get_text().strip()
+        profiles = self.get_profiles()
+        if profiles is None:
+            return None
+        if name not in profiles:
+            self.dialog_Message("Rule Profile", "There is no saved profile called '" + name + "'.  Untick 'Use profile' to use the options instead.")
+            return None
+        return profiles[name]
+
+    def button_Use_Profile_toggled(self, widget):  # Greys out the options while Process Files uses the selected profile instead of them
+        for name in ["entry_Audio_Languages", "entry_Audio_Name", "entry_Audio_Types", "entry_IDs_Audio", "entry_Subtitles_Languages", "entry_Subtitles_Name", "entry_Subtitles_Types", "entry_IDs_Subtitles", "combo_Title_Keep"]:
+            self.builder.get_object(name).set_sensitive(not widget.get_active())
+
+    def update_profile_names(self):  # Fills combo_Profile with the names of the saved rule profiles
+        combo_Profile = self.builder.get_object("combo_Profile")
+        combo_Profile.remove_all()
+        profiles = self.get_profiles()
+        if profiles is None:  # Carry on without any profiles
+            profiles = {}
+        for name in sorted(profiles):
+            combo_Profile.append_text(name)
+
+    def button_Profile_Load_clicked(self, widget):  # Fills in the option entries from the first rules of a saved profile
+        name = self.builder.get_object("combo_Profile").get_child().get_text().strip()
+        profiles = self.get_profiles()
+        if profiles is None:
+            return
+        if name not in profiles:
+            self.dialog_Message("Rule Profile", "There is no saved profile called '" + name + "'.")
+            return
+        profile = profiles[name]
+        audio_rule = {}
+        subtitle_rule = {}
+        if len(profile.get("audio", [])) > 0:
+            audio_rule = profile["audio"][0]
+        if len(profile.get("subtitles", [])) > 0:
+            subtitle_rule = profile["subtitles"][0]
+        self.builder.get_object("entry_Audio_Languages").set_text(audio_rule.get("languages", ""))
+        self.builder.get_object("entry_Audio_Name").set_text(audio_rule.get("name", ""))
+        self.builder.get_object("entry_Audio_Types").set_text(audio_rule.get("types", ""))
+        self.builder.get_object("entry_IDs_Audio").set_text(audio_rule.get("ids", ""))
+        self.builder.get_object("entry_Subtitles_Languages").set_text(subtitle_rule.get("languages", ""))
+        self.builder.get_object("entry_Subtitles_Name").set_text(subtitle_rule.get("name", ""))
+        self.builder.get_object("entry_Subtitles_Types").set_text(subtitle_rule.get("types", ""))
+        self.builder.get_object("entry_IDs_Subtitles").set_text(subtitle_rule.get("ids", ""))
+        if profile.get("keep_title", False):
+            self.builder.get_object("combo_Title_Keep").set_active(0)
+        else:
+            self.builder.get_object("combo_Title_Keep").set_active(1)
+
+    def button_Profile_Save_clicked(self, widget):  # Saves the option entries as the first rules of a profile
+        name = self.builder.get_object("combo_Profile").get_child().get_text().strip()
+        if len(name) == 0:
+            self.dialog_Message("Rule Profile", "Enter a name for the profile first.")
+            return
+        profiles = self.get_profiles()
+        if profiles is None:  # Don't overwrite a profiles file that couldn't be read
+            return
+        profile = profiles.get(name, {"audio": [], "subtitles": []})
+        audio_rule, subtitle_rule, keep_title = self.get_entry_rules()
+        # Replace the first rules, but keep any fallback rules that were added to the profiles file
+        profile["audio"] = [audio_rule] + profile.get("audio", [])[1:]
+        profile["subtitles"] = [subtitle_rule] + profile.get("subtitles", [])[1:]
+        profile["keep_title"] = keep_title
+        profiles[name] = profile
+        save_profiles(profiles)
+        self.update_profile_names()
+
     def button_Reset_clicked(self, widget):
         entry_Audio_Languages = self.builder.get_object("entry_Audio_Languages")
         entry_Audio_Name = self.builder.get_object("entry_Audio_Name")
@@ -599,17 +938,67 @@ class Main():
         # files_Full[9] = (audio tracks) {}
         # files_Full[10] = (subtitle tracks) {}
         global files
+        global verify_results
         files.clear()
         liststore_Data_Grid = self.builder.get_object("liststore_Data_Grid")
         liststore_Data_Grid.clear()
         # Build files from files_Full
+        if group_layouts:
+            self.load_Data_Grid_groups()
+            return
         # Get prefix and suffix for new file names
+        # The Audio and Subtitles columns are rendered by render_cell.  GtkTreeView still measures every row (the columns are auto-sized), but files with the same tracks share the memoized markup.
+        self.grid_sources = []
         for file in files_Full:
-            files.append([file[0], file[1], file[2], file[3], file[4]])
+            problems = verify_results.get(default_folder_path + "/" + str(file[0]), [])
+            if len(problems) > 0:  # Flag the files that failed verification
+                name = "<span foreground=\"red\">" + html.escape(str(file[0]), quote=False) + "</span>"
+                defaults = file[4] + "\n<span foreground=\"red\">" + html.escape("\n".join(problems), quote=False) + "</span>"
+                files.append([name, html.escape(str(file[1]), quote=False), "", "", defaults, len(self.grid_sources)])
+            else:
+                files.append([html.escape(str(file[0]), quote=False), html.escape(str(file[1]), quote=False), "", "", file[4], len(self.grid_sources)])
+            self.grid_sources.append(file)
         # Build data grid from files
         for file in files:
             liststore_Data_Grid.append(file)
 
+    def render_cell(self, column, renderer, model, tree_iter, index):  # Renders the Audio (index 2) or Subtitles (index 3) markup of a data grid row
+        file = self.grid_sources[model.get_value(tree_iter, 5)]  # The Source column, so that it doesn't matter if the rows get sorted
+        renderer.set_property("markup", render_tracks(file[index], multi_lines))
+
+    def load_Data_Grid_groups(self):  # Loads data grid with one row per track layout (e.g. "482 files share this layout")
+        global files
+        global verify_results
+        liststore_Data_Grid = self.builder.get_object("liststore_Data_Grid")
+        self.grid_sources = []
+        groups = {}  # The files_Full entries by track layout, in the order the layouts first appear
+        for file in files_Full:
+            if file[5] not in groups:
+                groups[file[5]] = []
+            groups[file[5]].append(file)
+        for layout in groups:
+            group = groups[layout]
+            name = html.escape(str(group[0][0]), quote=False)
+            if len(group) > 1:
+                name = name + "\n<i>" + str(len(group)) + " files share this layout</i>"
+            defaults = group[0][4]
+            problems = 0
+            for file in group:
+                if len(verify_results.get(default_folder_path + "/" + str(file[0]), [])) > 0:
+                    problems = problems + 1
+            if problems > 0:  # Flag the groups with files that failed verification
+                name = "<span foreground=\"red\">" + name + "</span>"
+                defaults = defaults + "\n<span foreground=\"red\">" + str(problems) + " of " + str(len(group)) + " files don't match the plan</span>"
+            title = html.escape(str(group[0][1]), quote=False)
+            for file in group:
+                if file[1] != group[0][1]:  # The titles aren't part of the layout
+                    title = "<i>(various)</i>"
+                    break
+            files.append([name, title, "", "", defaults, len(self.grid_sources)])
+            self.grid_sources.append(group[0])
+        for file in files:
+            liststore_Data_Grid.append(file)
+
 
 """ **************************************************************************************************************** """
 # "class Main()" ends here...
@@ -629,15 +1018,15 @@ def get_list_of_mkv_files():  # Gets the list of all files and folder from the d
     return file_list
 
 
-def populate_files_Full():
+def populate_files_Full(file_list=None):
     # This populates the files_Full list with all file/folder information, which is the basis of the data grid
     global files_Full
     # files_Full[0] = Current_Name
     # files_Full[1] = Title
-    # files_Full[2] = Audio
-    # files_Full[3] = Subtitles
+    # files_Full[2] = Audio (tuple of track tuples, see get_track_tuples)
+    # files_Full[3] = Subtitles (tuple of track tuples, see get_track_tuples)
     # files_Full[4] = Defaults
-    # files_Full[5] = ""
+    # files_Full[5] = Layout (hash of the track layout, see get_layout_key)
     # files_Full[6] = ""
     # files_Full[7] = (json data) {}
     # files_Full[8] = (video tracks) {}
@@ -645,9 +1034,14 @@ def populate_files_Full():
     # files_Full[10] = (subtitle tracks) {}
     files_Full.clear()
     files_temp = []
-    files_temp = get_list_of_mkv_files()
+    if file_list is None:
+        files_temp = get_list_of_mkv_files()
+    else:  # Only a given part of the folder (e.g. a shard)
+        files_temp = list(file_list)
     files_temp.sort()
-    for file in files_temp:
+    # Get information from the mkv files in json format (in parallel)
+    json_datas = identify_mkv_files([default_folder_path + "/" + file for file in files_temp])
+    for file, json_data in zip(files_temp, json_datas):
         part0 = file
         part1 = ""
         part2 = ""
@@ -655,12 +1049,7 @@ def populate_files_Full():
         part4 = ""
         part5 = ""
         part6 = ""
-        # Get information from mkv file in json format:
-        cmd = ["mkvmerge --identify --identification-format json \"" + default_folder_path + "/" + file + "\""]
-        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-        json_data, err = proc.communicate()
-        json_data = json_data.decode("utf-8")
-        part7 = json.loads(json_data)  # json information of all objects in the mkv file
+        part7 = json_data  # json information of all objects in the mkv file
         part8 = {}
         part9 = {}
         part10 = {}
@@ -671,6 +1060,739 @@ def populate_files_Full():
     parse_json_data()
 
 
+def get_track_language(track):  # Gets the language of a track from its json data
+    if "language_ietf" in track["properties"]:  # "language_ietf" isn't always a property...
+        return track["properties"]["language_ietf"]
+    elif "language" in track["properties"]:
+        return track["properties"]["language"]
+    else:
+        return ""
+
+
+def open_jsonl(jsonl_path, mode):  # Opens a snapshot/plan/results file as text, (de)compressing it based on its extension
+    if jsonl_path.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError("Reading/writing *.zst files needs the 'zstandard' python module (pip install zstandard)")
+        if mode == "w":
+            return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(open(jsonl_path, "wb")), encoding="utf-8")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(jsonl_path, "rb")), encoding="utf-8")
+    elif jsonl_path.endswith(".gz"):
+        return gzip.open(jsonl_path, mode + "t", encoding="utf-8", compresslevel=6)
+    else:
+        return open(jsonl_path, mode, encoding="utf-8")
+
+
+def read_jsonl(jsonl_path):  # Reads a snapshot/plan/results file and returns its header and all of its rows
+    with open_jsonl(jsonl_path, "r") as jsonl:
+        header = json.loads(jsonl.readline())
+        rows = json.loads("[" + ",".join(jsonl.read().splitlines()) + "]")  # One json decode for all the rows is a lot faster than one per row
+    return header, rows
+
+
+def write_jsonl(jsonl_path, header, rows):  # Writes a snapshot/plan/results file:  a header line, then one row (list) per line
+    with open_jsonl(jsonl_path, "w") as jsonl:
+        jsonl.write(json.dumps(header) + "\n")
+        for row in rows:
+            jsonl.write(json.dumps(row, separators=(",", ":")) + "\n")
+
+
+def export_snapshot(snapshot_path):  # Writes files_Full to a snapshot:  a header line, then one row (list of snapshot_columns) per track
+    global files_Full
+    rows = []
+    for file in files_Full:
+        title = file[7].get("container", {}).get("properties", {}).get("title", "")
+        tracks = file[7].get("tracks")
+        if not tracks:  # Keep files without tracks, so that the file list is complete
+            rows.append([file[0], title, None, "", "", "", "", False])
+            continue
+        for track in tracks:
+            rows.append([file[0], title, track["id"], track["type"], get_track_language(track), track["codec"], track["properties"].get("track_name", ""), track["properties"].get("default_track") == True])
+    write_jsonl(snapshot_path, {"folder": default_folder_path, "columns": snapshot_columns}, rows)
+
+
+def import_snapshot(snapshot_path):  # Rebuilds files_Full (and default_folder_path) from a snapshot instead of reading the mkv files
+    global default_folder_path
+    global files_Full
+    files_Full.clear()
+    header, rows = read_jsonl(snapshot_path)
+    default_folder_path = header["folder"]
+    column = {name: index for index, name in enumerate(header["columns"])}
+    current_file = None
+    for row in rows:
+        if row[column["file"]] != current_file:
+            current_file = row[column["file"]]
+            # Rebuild just enough of the mkvmerge json for parse_json_data
+            json_data = {"container": {"properties": {"title": row[column["title"]]}}, "tracks": []}
+            if row[column["title"]] == "":
+                json_data["container"]["properties"].pop("title")
+            files_Full.append([current_file, "", "", "", "", "", "", json_data, {}, {}, {}, []])
+        if row[column["track_id"]] is not None:
+            properties = {"language": row[column["language"]], "default_track": row[column["default"]]}
+            if row[column["name"]] != "":
+                properties["track_name"] = row[column["name"]]
+            json_data["tracks"].append({"id": row[column["track_id"]], "type": row[column["kind"]], "codec": row[column["codec"]], "properties": properties})
+    parse_json_data()
+
+
+def save_plan(plan_path):  # Writes the plans to a plan file, so they can be applied somewhere else (e.g. per shard)
+    global plans
+    rows = []
+    for file_path in plans:
+        rows.append(get_plan_row(file_path, plans[file_path]))
+    write_jsonl(plan_path, {"columns": plan_columns}, rows)
+
+
+def get_plan_row(file_path, plan):  # Gets the plan file row (plan_columns) of a plan
+    return [file_path, plan["title"], plan["tracks"], plan["defaults"], plan.get("impact")]
+
+
+def load_plan(plan_path):  # Reads the plans from a plan file
+    global plans
+    plans.clear()
+    header, rows = read_jsonl(plan_path)
+    column = {name: index for index, name in enumerate(header["columns"])}
+    for row in rows:
+        plans[row[column["file"]]] = {"title": row[column["title"]], "tracks": row[column["tracks"]], "defaults": row[column["defaults"]]}
+        if "impact" in column:  # Older plan files don't have it
+            plans[row[column["file"]]]["impact"] = row[column["impact"]]
+
+
+def build_mkvpropedit_command(file_path, plan):  # Builds the mkvpropedit argument list that applies a plan to a file
+    command = ["mkvpropedit", file_path, "--edit", "info"]
+    if plan["title"] is not None:
+        command = command + ["--set", "title=" + plan["title"]]
+    # Note: Since tracks are zero based, need to use (track_ID + 1)
+    for track in plan["tracks"]:
+        if track in plan["defaults"]:
+            command = command + ["--edit", "track:" + str(int(track) + 1), "--set", "flag-default=1"]
+        else:
+            command = command + ["--edit", "track:" + str(int(track) + 1), "--set", "flag-default=0"]
+    return command
+
+
+def get_priority_command():  # Gets the command prefix that runs a child process with the apply_options' I/O priority and CPU nice
+    command = []
+    if apply_options["ionice"] == "idle":
+        command = command + ["ionice", "-c", "3"]  # Only gets disk time when nothing else needs it
+    elif apply_options["ionice"] == "best-effort":
+        command = command + ["ionice", "-c", "2", "-n", "7"]  # Lowest best-effort priority
+    if int(apply_options["nice"]) > 0:
+        command = command + ["nice", "-n", str(int(apply_options["nice"]))]
+    return command
+
+
+def order_for_locality(file_paths):  # Orders the files so that the ones on the same device and in the same folder are applied together
+    def locality(file_path):
+        try:
+            device = os.stat(file_path).st_dev
+        except OSError:
+            device = -1
+        return (device, os.path.dirname(file_path), os.path.basename(file_path))
+    return sorted(file_paths, key=locality)
+
+
+def rate_limited(items, cancel=None):  # Passes (file_path, plan) items through, sleeping as needed to stay under the apply_options' files/MB (written) per second.  Stops once 'cancel' (a threading.Event) is set.
+    start = time.monotonic()
+    budget = 0.0  # How many seconds the items so far are allowed to take
+    for item in items:
+        if cancel is not None and cancel.is_set():
+            return
+        yield item
+        seconds = 0.0
+        if apply_options["rate_files"] > 0:
+            seconds = 1.0 / apply_options["rate_files"]
+        if apply_options["rate_mb"] > 0:  # A header edit only writes a few blocks, not the whole file
+            seconds = max(seconds, impact_bytes[get_impact_class(item[1])] / (apply_options["rate_mb"] * 1024 * 1024))
+        budget = budget + seconds
+        wait = start + budget - time.monotonic()
+        if wait > 0:
+            if cancel is None:
+                time.sleep(wait)
+            elif cancel.wait(wait):
+                return
+
+
+def add_apply_timing(kind, seconds):  # Adds one file's measured edit (by impact) or verify time to apply_timings, for estimate_impact
+    timing = apply_timings.setdefault(kind, [0, 0.0])
+    timing[0] = timing[0] + 1
+    timing[1] = timing[1] + seconds
+
+
+def apply_plan(file_path, plan, verify=True):  # Runs mkvpropedit for one planned file, then verifies it.  Returns its result row.
+    result = run_process(get_priority_command() + build_mkvpropedit_command(file_path, plan), retry_on_timeout=False)  # A timed out mkvpropedit might still be writing the header
+    if result.returncode not in [0, 1]:  # mkvpropedit:  0 = OK, 1 = warnings, 2 = error  (-1 = timed out or couldn't run)
+        problems = ["mkvpropedit failed:  " + (result.stdout + result.stderr).decode("utf-8", errors="replace").strip()]
+    else:
+        add_apply_timing(get_impact_class(plan), result.run_seconds)  # How long each kind of edit takes (without waiting for a process slot)
+        problems = []
+        if verify:
+            verify_result = run_process(get_identify_command(file_path))
+            add_apply_timing("verify", verify_result.run_seconds)
+            problems = check_plan(file_path, plan, read_identify_result(verify_result))
+    return [file_path, result.returncode, problems]
+
+
+def apply_plans(file_paths, verify=True, cancel=None, progress=None):  # Runs mkvpropedit for the planned files (rate limited), then verifies each one.  Returns a list of result rows (only of the files done before 'cancel' was set).
+    global plans
+    results = []
+    for file_path, plan in rate_limited(((file_path, plans[file_path]) for file_path in file_paths), cancel):
+        results.append(apply_plan(file_path, plan, verify))
+        if progress is not None:
+            progress(len(results), len(file_paths))
+    save_throughput()
+    return results
+
+
+def get_plan_impact(plan, current_title, current_defaults):  # Works out what applying a plan changes in a file:  "unchanged", "flags" (only default flags) or "title" (the title, and maybe default flags)
+    if plan["title"] is not None and plan["title"] != current_title:
+        return "title"
+    actual_defaults = sorted([int(track) for track in current_defaults if int(track) in plan["tracks"]])
+    if actual_defaults != plan["defaults"]:
+        return "flags"
+    return "unchanged"
+
+
+def get_impact_class(plan):  # Gets the impact of a plan, guessing it for (older) plans without one
+    if plan.get("impact") is not None:
+        return legacy_impacts.get(plan["impact"], plan["impact"])
+    if plan["title"] is not None:
+        return "title"
+    return "flags"
+
+
+def get_impact_comment(plan):  # Gets what applying a plan changes in its file, to go after the file's name in the output, e.g. "  (title change)"
+    if plan is None:
+        return ""
+    return "  (" + impact_names[get_impact_class(plan)] + ")"
+
+
+def load_throughput():  # Reads the measured apply times:  {impact (or "verify"): [files, seconds]}
+    if not os.path.isfile(throughput_path):
+        return {}
+    try:
+        with open(throughput_path, "r", encoding="utf-8") as throughput_file:
+            return json.load(throughput_file)
+    except (ValueError, OSError) as error:  # Only used for estimates, so carry on as if nothing was measured yet
+        print("Could not read " + throughput_path + " (ignoring it):  " + str(error))
+        return {}
+
+
+def save_throughput():  # Adds the current run's apply times to the measured ones
+    global apply_timings
+    if len(apply_timings) == 0:
+        return
+    throughput = load_throughput()
+    for impact in legacy_impacts:  # Measured differently (including the wait for a process slot, without the verify), so start over
+        throughput.pop(impact, None)
+    for impact in apply_timings:
+        files, seconds = throughput.get(impact, [0, 0.0])
+        files = files + apply_timings[impact][0]
+        seconds = seconds + apply_timings[impact][1]
+        while files > 10000:  # Let the older runs fade out, so that the estimate follows the hardware
+            files = files / 2
+            seconds = seconds / 2
+        throughput[impact] = [files, seconds]
+    apply_timings = {}
+    try:
+        os.makedirs(os.path.dirname(throughput_path), exist_ok=True)
+        temp_path = throughput_path + "." + str(os.getpid()) + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as throughput_file:  # Replace it in one go, shard workers might be saving at the same time
+            json.dump(throughput, throughput_file, indent=2)
+        os.replace(temp_path, throughput_path)
+    except OSError as error:  # Only used for estimates, the plans have already been applied
+        print("Could not save " + throughput_path + ":  " + str(error))
+
+
+def estimate_impact(file_paths, parallel_verify=False):  # Estimates how much I/O and time applying (and verifying) the plans of the files will take (a dry run).  Apply Now verifies all of the files in parallel afterwards, --apply-plan one by one.
+    global plans
+    throughput = load_throughput()
+    estimate = {"files": len(file_paths), "counts": {"unchanged": 0, "flags": 0, "title": 0}, "bytes": 0, "file_bytes": 0, "seconds": 0.0, "measured": True}
+    for file_path in file_paths:
+        impact = get_impact_class(plans[file_path])
+        estimate["counts"][impact] = estimate["counts"][impact] + 1
+        try:
+            file_size = os.path.getsize(file_path)
+            estimate["bytes"] = estimate["bytes"] + min(impact_bytes[impact], file_size)
+            if impact != "unchanged":  # Only the files that get touched
+                estimate["file_bytes"] = estimate["file_bytes"] + file_size
+        except OSError:  # e.g. a snapshot of a folder that isn't on this machine
+            estimate["bytes"] = estimate["bytes"] + impact_bytes[impact]
+        for kind in [impact, "verify"]:  # Every file is edited, then re-read
+            if kind in throughput and throughput[kind][0] > 0:
+                seconds = throughput[kind][1] / throughput[kind][0]
+            else:
+                seconds = default_seconds_per_file[kind]
+                estimate["measured"] = False
+            if kind == "verify" and parallel_verify:
+                seconds = seconds / process_options["max_processes"]
+            estimate["seconds"] = estimate["seconds"] + seconds
+    # A rate limit can make it take longer
+    if apply_options["rate_files"] > 0:
+        estimate["seconds"] = max(estimate["seconds"], len(file_paths) / apply_options["rate_files"])
+    if apply_options["rate_mb"] > 0:
+        estimate["seconds"] = max(estimate["seconds"], estimate["bytes"] / (apply_options["rate_mb"] * 1024 * 1024))
+    return estimate
+
+
+def format_size(size):  # Formats a number of bytes, e.g. "1.5 GB"
+    for unit in ["bytes", "KB", "MB", "GB", "TB"]:
+        if size < 1024 or unit == "TB":
+            if unit == "bytes":
+                return str(int(size)) + " " + unit
+            return "{0:.1f} {1}".format(size, unit)
+        size = size / 1024
+
+
+def format_impact(estimate):  # Formats an impact estimate as lines of text
+    lines = []
+    lines.append("Estimated impact of " + str(estimate["files"]) + " files:  " + str(estimate["counts"]["flags"]) + " default flag changes, " + str(estimate["counts"]["title"]) + " title changes, " + str(estimate["counts"]["unchanged"]) + " already as planned")
+    lines.append("Roughly " + format_size(estimate["bytes"]) + " written (a rough constant per kind of change, not a measurement), in edited files totalling " + format_size(estimate["file_bytes"]))
+    if estimate["measured"]:
+        lines.append("Estimated time:  " + str(datetime.timedelta(seconds=round(estimate["seconds"]))) + " (based on earlier runs)")
+    else:
+        lines.append("Estimated time:  " + str(datetime.timedelta(seconds=round(estimate["seconds"]))) + " (rough, there are no measurements from earlier runs yet)")
+    return lines
+
+
+def load_profiles():  # Reads the saved rule profiles:  {name: {"keep_title": bool, "audio": [rules], "subtitles": [rules]}}
+    if not os.path.isfile(profiles_path):
+        return {}
+    with open(profiles_path, "r", encoding="utf-8") as profiles_file:
+        return json.load(profiles_file)
+
+
+def save_profiles(profiles):
+    os.makedirs(os.path.dirname(profiles_path), exist_ok=True)
+    with open(profiles_path, "w", encoding="utf-8") as profiles_file:
+        json.dump(profiles, profiles_file, indent=2, sort_keys=True)
+
+
+def split_criteria(text):  # Splits a comma separated criteria string into a list of values
+    return [value.strip() for value in str(text).split(",") if len(value.strip()) > 0]
+
+
+def track_matches_rule(track_id, track, rule):  # Checks if a track matches every filled in field of a rule (an empty rule matches any track)
+    if len(split_criteria(rule.get("languages", ""))) > 0:
+        if track["track_lang"].lower() not in [lang.lower() for lang in split_criteria(rule["languages"])]:
+            return False
+    if len(rule.get("name", "")) > 0:
+        if rule["name"].upper() not in track["track_name"].upper():
+            return False
+    if len(rule.get("types", "")) > 0:
+        if rule["types"].upper() not in track["track_type"].upper():
+            return False
+    if len(split_criteria(rule.get("ids", ""))) > 0:
+        if str(track_id) not in split_criteria(rule["ids"]):
+            return False
+    return True
+
+
+def evaluate_rules(tracks, rules):  # Goes through the ordered (fallback) rules and returns the first track that matches, as a list of default track IDs
+    for rule in rules:
+        for track_id in tracks:
+            if track_matches_rule(track_id, tracks[track_id], rule):
+                return [int(track_id)]
+    return []
+
+
+def build_profile_plan(audio, subtitles, profile):  # Builds the plan of one file from its parsed audio/subtitle tracks, based on a rule profile
+    if profile.get("keep_title", False):
+        plan_title = None  # The title isn't touched
+    else:
+        plan_title = ""
+    plan_defaults = evaluate_rules(audio, profile.get("audio", [])) + evaluate_rules(subtitles, profile.get("subtitles", []))
+    plan_defaults.sort()
+    return {"title": plan_title, "tracks": [int(track) for track in list(audio) + list(subtitles)], "defaults": plan_defaults}
+
+
+def plan_profile(profile):  # Adds a plan for every file in files_Full (of default_folder_path), based on a rule profile
+    global files_Full
+    global plans
+    layout_plans = {}  # Files with the same track layout get the same plan, so the rules only need to be evaluated once per layout
+    for file in files_Full:
+        if file[5] not in layout_plans:
+            layout_plans[file[5]] = build_profile_plan(file[9], file[10], profile)
+        plan = dict(layout_plans[file[5]])
+        plan["impact"] = get_plan_impact(plan, file[1], file[11])  # The title isn't part of the layout
+        plans[default_folder_path + "/" + str(file[0])] = plan
+
+
+def plan_profile_folders(profile, folders):  # Evaluates a rule profile over many folders at once, giving one combined plan
+    global default_folder_path
+    global plans
+    plans.clear()
+    for folder in folders:
+        default_folder_path = os.path.abspath(folder)
+        populate_files_Full()
+        plan_profile(profile)
+    return plans
+
+
+""" **************************************************************************************************************** """
+# The streaming pipeline for headless whole-library runs:  list -> probe -> parse -> rule -> plan -> apply/export
+# Every stage is a generator that handles one file at a time, so memory use doesn't grow with the size of the library.
+""" **************************************************************************************************************** """
+
+
+def stream_mkv_files(folders):  # Lists the mkv files (full paths) of the folders and all of their sub folders (e.g. a whole library root), one folder at a time
+    for root in folders:
+        for folder, dirnames, filenames in os.walk(os.path.abspath(root)):
+            dirnames.sort()  # os.walk goes into the sub folders in this order
+            for file in sorted(filenames):
+                if str(file[-4:]).lower() == ".mkv" and os.path.isfile(folder + "/" + file):
+                    yield folder + "/" + file
+
+
+def stream_probe(file_paths, window=None):  # Reads the files' json data in parallel, in order.  At most 'window' files are read ahead of the consumer (backpressure).
+    if window is None:
+        window = probe_workers
+    pending = collections.deque()
+    for file_path in file_paths:
+        pending.append((file_path, submit_process(get_identify_command(file_path))))
+        if len(pending) >= window:
+            file_path, future = pending.popleft()
+            yield file_path, read_identify_result(future.result())
+    while len(pending) > 0:
+        file_path, future = pending.popleft()
+        yield file_path, read_identify_result(future.result())
+
+
+def stream_plans(folders, profile, window=None):  # Parses each probed file and evaluates the rule profile on it, without keeping the json data around
+    for file_path, json_data in stream_probe(stream_mkv_files(folders), window):
+        parsed = parse_tracks(json_data)
+        plan = build_profile_plan(parsed["audio"], parsed["subtitles"], profile)
+        plan["impact"] = get_plan_impact(plan, parsed["title"], [str(track_id) for track_id, kind in parsed["defaults"]])
+        yield file_path, plan
+
+
+def stream_apply(planned):  # Applies (and verifies) each plan as soon as it comes out of the pipeline (the files already come out folder by folder)
+    for file_path, plan in rate_limited(planned):
+        yield apply_plan(file_path, plan)
+    save_throughput()
+
+
+def write_manifest(manifest_path, shards):  # Writes the list of mkv files of default_folder_path to a manifest that is shared by all of the shards
+    manifest = {"folder": os.path.abspath(default_folder_path), "shards": int(shards), "files": get_list_of_mkv_files()}  # Every node needs to mount the folder at the same path
+    with open(manifest_path, "w", encoding="utf-8") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+    return manifest
+
+
+def read_manifest(manifest_path):
+    with open(manifest_path, "r", encoding="utf-8") as manifest_file:
+        return json.load(manifest_file)
+
+
+def get_shard_files(manifest, shard):  # Gets the files of a shard:  the manifest's (sorted) file list split into contiguous blocks, so that each node keeps the ordering
+    file_count = len(manifest["files"])
+    start = (file_count * shard) // manifest["shards"]
+    end = (file_count * (shard + 1)) // manifest["shards"]
+    return manifest["files"][start:end]
+
+
+def run_shard(manifest_path, shard, snapshot_path, plan_path, results_path, options=None, runner_options=None):  # Scans and/or applies one shard of a manifest, writing its own output files
+    global default_folder_path
+    if options is not None:  # Worker processes don't necessarily inherit the globals
+        apply_options.update(options)
+    if runner_options is not None:
+        process_options.update(runner_options)
+    manifest = read_manifest(manifest_path)
+    default_folder_path = manifest["folder"]
+    shard_files = get_shard_files(manifest, shard)
+    if snapshot_path:
+        populate_files_Full(shard_files)
+        export_snapshot(snapshot_path)
+    if plan_path:
+        load_plan(plan_path)
+        shard_file_paths = [default_folder_path + "/" + file for file in shard_files if default_folder_path + "/" + file in plans]
+        write_jsonl(results_path, {"columns": result_columns}, apply_plans(order_for_locality(shard_file_paths)))
+
+
+def merge_shards(manifest_path, shard_paths, merged_path):  # Merges the per shard snapshots or results back into one file, in the manifest's order
+    manifest = read_manifest(manifest_path)
+    order = {}
+    for index, file in enumerate(manifest["files"]):
+        order[file] = index
+        order[manifest["folder"] + "/" + file] = index  # Plans and results use the full path
+    merged_header = None
+    merged_rows = []
+    for shard_path in shard_paths:
+        header, rows = read_jsonl(shard_path)
+        if merged_header is None:
+            merged_header = header
+        merged_rows.extend(rows)
+    file_column = merged_header["columns"].index("file")
+    merged_rows.sort(key=lambda row: order.get(row[file_column], len(order)))  # sort() is stable, so the tracks of a file stay in order
+    write_jsonl(merged_path, merged_header, merged_rows)
+    return merged_header, merged_rows
+
+
+def run_shards_locally(manifest_path, workers, snapshot_path, plan_path, results_path):  # Runs every shard of a manifest in its own local worker process, then merges the outputs
+    manifest = read_manifest(manifest_path)
+    jobs = []
+    for shard in range(manifest["shards"]):
+        shard_snapshot_path = ""
+        shard_results_path = ""
+        if snapshot_path:
+            shard_snapshot_path = snapshot_path + ".shard" + str(shard)
+        if plan_path:
+            shard_results_path = results_path + ".shard" + str(shard)
+        jobs.append((manifest_path, shard, shard_snapshot_path, plan_path, shard_results_path, dict(apply_options), dict(process_options)))
+    with multiprocessing.Pool(int(workers)) as pool:
+        pool.starmap(run_shard, jobs)
+    if snapshot_path:
+        merge_shards(manifest_path, [job[2] for job in jobs], snapshot_path)
+    if plan_path:
+        merge_shards(manifest_path, [job[4] for job in jobs], results_path)
+    for job in jobs:  # Clean up the per shard files
+        for shard_path in [job[2], job[4]]:
+            if shard_path and os.path.exists(shard_path):
+                os.remove(shard_path)
+
+
+def summarize_results(rows):  # Prints the failures of apply result rows as they go by and passes the rows through, then prints a summary
+    count = 0
+    failed = 0
+    for row in rows:
+        count = count + 1
+        if len(row[2]) > 0:
+            failed = failed + 1
+            print("FAILED:  " + str(row[0]) + ":  " + "; ".join(row[2]))
+        yield row
+    print(str(count) + " files applied, " + str(count - failed) + " OK, " + str(failed) + " failed")
+
+
+def print_results_summary(rows):  # Prints a summary of apply results
+    for row in summarize_results(rows):
+        pass
+
+
+def get_process_loop():  # Gets (starting it the first time) the event loop that runs the child processes
+    global process_loop
+    if process_loop is None:
+        process_loop = asyncio.new_event_loop()
+        threading.Thread(target=process_loop.run_forever, name="process_loop", daemon=True).start()
+    return process_loop
+
+
+def reset_process_loop():  # A forked worker process doesn't get the parent's process_loop thread, so it has to start its own
+    global process_loop
+    global process_semaphore
+    process_loop = None
+    process_semaphore = None
+
+
+os.register_at_fork(after_in_child=reset_process_loop)
+
+
+def is_transient_error(result):  # Checks if a failed child process is worth retrying (e.g. a timeout or a hiccup of a network share)
+    if result.returncode in [0, 1]:
+        return False
+    if result.returncode == -1:  # Timed out or couldn't be started
+        return True
+    output = (result.stdout + result.stderr).decode("utf-8", errors="replace").lower()
+    for message in ["input/output error", "stale file handle", "resource temporarily unavailable", "interrupted system call"]:
+        if message in output:
+            return True
+    return False
+
+
+async def run_process_async(command, timeout=None, retry_on_timeout=True):  # Runs a command (argument list, no shell) with a timeout and retries, within the global process budget.  Commands that write should pass retry_on_timeout=False.
+    global process_semaphore
+    if process_semaphore is None:
+        process_semaphore = asyncio.Semaphore(process_options["max_processes"])
+    if timeout is None:
+        timeout = process_options["timeout"]
+    attempt = 0
+    run_seconds = 0.0  # How long the command ran (every attempt), without waiting for a process slot or the retry delays
+    while True:
+        retry = True
+        async with process_semaphore:
+            started = time.monotonic()
+            try:
+                proc = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+                try:
+                    stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+                    result = subprocess.CompletedProcess(command, proc.returncode, stdout, stderr)
+                except asyncio.TimeoutError:
+                    proc.kill()
+                    try:
+                        await asyncio.wait_for(proc.wait(), 5)
+                    except asyncio.TimeoutError:  # e.g. stuck on a stale NFS handle, give up on it
+                        pass
+                    result = subprocess.CompletedProcess(command, -1, b"", ("Timed out after " + str(timeout) + " seconds").encode("utf-8"))
+                    retry = retry_on_timeout  # The killed writer might still be alive, so don't start another one on the same file
+            except OSError as error:
+                result = subprocess.CompletedProcess(command, -1, b"", str(error).encode("utf-8"))
+                retry = error.errno in [errno.EAGAIN, errno.ENOMEM, errno.EMFILE, errno.ENFILE, errno.EIO]  # Not e.g. when the program isn't installed
+            run_seconds = run_seconds + time.monotonic() - started
+        result.run_seconds = run_seconds
+        if not retry or attempt >= process_options["retries"] or not is_transient_error(result):
+            return result
+        await asyncio.sleep(process_options["backoff"] * (2 ** attempt))
+        attempt = attempt + 1
+
+
+def submit_process(command, timeout=None, retry_on_timeout=True):  # Starts running a command on the process loop, returns a (concurrent.futures) future of its subprocess.CompletedProcess
+    return asyncio.run_coroutine_threadsafe(run_process_async(command, timeout, retry_on_timeout), get_process_loop())
+
+
+def run_process(command, timeout=None, retry_on_timeout=True):  # Runs a command and waits for its subprocess.CompletedProcess
+    return submit_process(command, timeout, retry_on_timeout).result()
+
+
+def run_processes(commands, timeout=None):  # Runs many commands at the same time (within the global process budget) and waits for all of them, in order
+    futures = [submit_process(command, timeout) for command in commands]
+    return [future.result() for future in futures]
+
+
+def get_identify_command(file_path):
+    return ["mkvmerge", "--identify", "--identification-format", "json", file_path]
+
+
+def read_identify_result(result):  # Gets the json data from a finished mkvmerge --identify, or an empty one with the errors if it failed
+    try:
+        json_data = json.loads(result.stdout.decode("utf-8"))
+    except ValueError:
+        json_data = {"errors": [result.stderr.decode("utf-8", errors="replace").strip() or "mkvmerge gave no output"]}
+    json_data.setdefault("container", {}).setdefault("properties", {})
+    return json_data
+
+
+def identify_mkv_file(file_path):  # Gets the information from an mkv file in json format
+    return read_identify_result(run_process(get_identify_command(file_path)))
+
+
+def identify_mkv_files(file_paths):  # Gets the information from many mkv files (in parallel) in json format
+    return [read_identify_result(result) for result in run_processes([get_identify_command(file_path) for file_path in file_paths])]
+
+
+def check_plan(file_path, plan, json_data):  # Compares the actual state of a file with its plan and returns a list of the differences
+    problems = []
+    if json_data.get("tracks") is None:
+        problems.append("Could not read the tracks:  " + "; ".join(json_data.get("errors", [])))
+        return problems
+    actual_defaults = []
+    for track in json_data["tracks"]:
+        if track["id"] in plan["tracks"] and track["properties"].get("default_track") == True:
+            actual_defaults.append(track["id"])
+    actual_defaults.sort()
+    if actual_defaults != plan["defaults"]:
+        problems.append("Defaults are " + str(actual_defaults) + ", expected " + str(plan["defaults"]))
+    if plan["title"] is not None:
+        actual_title = json_data.get("container", {}).get("properties", {}).get("title", "")
+        if actual_title != plan["title"]:
+            problems.append("Title is '" + str(actual_title) + "', expected '" + str(plan["title"]) + "'")
+    return problems
+
+
+def check_plans(file_paths):  # Re-reads the planned files (in parallel) and checks them, without touching files_Full.  Returns {file_path: problems} and {file_path: json data} of the files that could be read.
+    global plans
+    problems = {}
+    json_datas = {}
+    for file_path, json_data in zip(file_paths, identify_mkv_files(file_paths)):
+        problems[file_path] = check_plan(file_path, plans[file_path], json_data)
+        if json_data.get("tracks") is not None:  # A file that couldn't be read keeps its tracks, the problem is only in the verify results
+            json_datas[file_path] = json_data
+    return problems, json_datas
+
+
+def update_files_Full(json_datas):  # Keeps the data grid up to date with the re-read json data ({file_path: json data}) of the files
+    global files_Full
+    for i in range(len(files_Full)):
+        file_path = default_folder_path + "/" + str(files_Full[i][0])
+        if file_path in json_datas:
+            files_Full[i][7] = json_datas[file_path]
+    parse_json_data()
+
+
+def verify_plans(file_paths=None):  # Re-reads only the planned files (or the given ones of them, in parallel) and checks that their headers match the plan
+    global plans
+    global verify_results
+    if file_paths is None:
+        file_paths = list(plans.keys())
+    problems, json_datas = check_plans(file_paths)
+    verify_results.clear()
+    verify_results.update(problems)
+    update_files_Full(json_datas)
+    return verify_results
+
+
+def parse_tracks(json_data):  # Parses the json data of one mkv file into its title, tracks (by type) and default (non-video) tracks
+    parsed = {"title": "", "video": {}, "audio": {}, "subtitles": {}, "defaults": []}
+    if "title" in json_data["container"]["properties"]:
+        parsed["title"] = json_data["container"]["properties"]["title"]
+    if json_data.get("tracks") is None:
+        return parsed
+    for track in json_data["tracks"]:
+        # track_type = track["properties"]["codec_id"]
+        track_type = track["codec"]
+        track_id = track["id"]
+        if track["properties"].get("default_track") == True:
+            if str(track["type"]).upper() != "video".upper():
+                parsed["defaults"].append((track_id, track["type"]))
+        track_lang = get_track_language(track)
+        if not (track["properties"].get("track_name") is None):
+            track_name = track["properties"]["track_name"]
+        else:
+            track_name = ""
+        if track["type"] == "video":
+            if "display_dimensions" in track["properties"]:
+                track_disdim = track["properties"]["display_dimensions"]
+            else:
+                track_disdim = ""
+            parsed["video"][track_id] = {"track_type": track_type, "track_lang": track_lang, "track_name": track_name, "track_disdim": track_disdim}
+        elif track["type"] == "audio":
+            parsed["audio"][track_id] = {"track_type": track_type, "track_lang": track_lang, "track_name": track_name}
+        elif track["type"] == "subtitles":
+            if "encoding" in track["properties"]:
+                track_encode = track["properties"]["encoding"]
+            else:
+                track_encode = ""
+            parsed["subtitles"][track_id] = {"track_type": track_type, "track_lang": track_lang, "track_name": track_name, "track_encode": track_encode}
+        else:
+            print("Unknown track type = " + str(track["type"]))
+    return parsed
+
+
+def get_layout_key(parsed):  # Gets a hash of a file's track layout (audio/subtitle IDs, types, languages, names and defaults), which is the same for e.g. all episodes of a season
+    layout = []
+    for kind in ["audio", "subtitles"]:
+        for track_id in parsed[kind]:
+            layout.append([kind, track_id, parsed[kind][track_id]["track_type"], parsed[kind][track_id]["track_lang"], parsed[kind][track_id]["track_name"]])
+    layout.append([track_id for track_id, kind in parsed["defaults"]])
+    return hashlib.sha1(json.dumps(layout).encode("utf-8")).hexdigest()
+
+
+def get_track_tuples(tracks, defaults):  # Turns parsed tracks into a tuple of (ID, language, type, name, default) tuples, which can be used as a (memoized) rendering key
+    return tuple((track_id, tracks[track_id]["track_lang"], tracks[track_id]["track_type"], tracks[track_id]["track_name"], str(track_id) in defaults) for track_id in tracks)
+
+
+@functools.lru_cache(maxsize=65536)
+def render_track(track):  # Renders one track's Pango markup, e.g. "<b>1-jpn ('Main' AAC)</b>".  Identical tracks get the very same string.
+    track_id, track_lang, track_type, track_name, default = track
+    if track_name == "":
+        text = "{0}-{1} ({2})".format(track_id, track_lang, track_type)
+    else:
+        text = "{0}-{1} ('{3}' {2})".format(track_id, track_lang, track_type, track_name)
+    text = html.escape(text, quote=False)  # Escape &, < and > so that they don't break the markup
+    if default:
+        return "<b>" + text + "</b>"
+    return text
+
+
+@functools.lru_cache(maxsize=65536)
+def render_tracks(tracks, multi_line):  # Renders the Pango markup of the Audio/Subtitles data grid columns from a tuple of track tuples
+    if multi_line:
+        return "\n".join([render_track(track) for track in tracks])
+    return ",  ".join([render_track(track) for track in tracks])
+
+
+@functools.lru_cache(maxsize=65536)
+def render_defaults(defaults):  # Renders the Pango markup of the Defaults data grid column from a tuple of (ID, type) tuples
+    return "\n".join(["<b>" + str(track_id) + "</b>-" + html.escape(str(kind), quote=False) for track_id, kind in defaults])
+
+
 def parse_json_data():
     global files_Full
     global languages_audio
@@ -679,7 +1801,6 @@ def parse_json_data():
     global types_subtitle
     global ids_audio
     global ids_subtitle
-    global multi_lines
     # Clear the lists
     languages_audio.clear()
     languages_subtitle.clear()
@@ -688,62 +1809,34 @@ def parse_json_data():
     ids_audio.clear()
     ids_subtitle.clear()
     # Parse the json data to get the individual tracks for the various types
+    layout_tracks = {}  # (audio tracks, subtitle tracks, defaults) by track layout
     for i in range(len(files_Full)):
-        if "title" in files_Full[i][7]["container"]["properties"]:
-            files_Full[i][1] = files_Full[i][7]["container"]["properties"]["title"]
-        if not (files_Full[i][7].get("tracks") is None):
-            command = ""
-            for track in files_Full[i][7]["tracks"]:
-                # track_type = track["properties"]["codec_id"]
-                track_type = track["codec"]
-                track_id = track["id"]
-                if track["properties"].get("default_track") == True:
-                    if str(track["type"]).upper() != "video".upper():
-                        files_Full[i][11].append(str(track_id))
-                        if len(files_Full[i][4]) == 0:
-                            files_Full[i][4] = "<b>" + str(track_id) + "</b>-" + str(track["type"])
-                        else:
-                            files_Full[i][4] = files_Full[i][4] + "\n<b>" + str(track_id) + "</b>-" + str(track["type"])
-                if track["type"] == "audio":  # Populate the track IDs for the audio tracks
-                    if str(track_id) not in ids_audio:
-                        ids_audio.append(str(track_id))
-                if track["type"] == "subtitles":  # Populate the track IDs for the subtitle tracks
-                    if str(track_id) not in ids_subtitle:
-                        ids_subtitle.append(str(track_id))
-                if "language_ietf" in track["properties"]:  # "language_ietf" isn't always a property...
-                    track_lang = track["properties"]["language_ietf"]
-                elif "language" in track["properties"]:
-                    track_lang = track["properties"]["language"]
-                else:
-                    track_lang = ""
-                if not (track["properties"].get("track_name") is None):
-                    track_name = track["properties"]["track_name"]
-                else:
-                    track_name = ""
-                if track["type"] == "video":
-                    if "display_dimensions" in track["properties"]:
-                        track_disdim = track["properties"]["display_dimensions"]
-                    else:
-                        track_disdim = ""
-                    files_Full[i][8][track_id] = {"track_type": track_type, "track_lang": track_lang, "track_name": track_name, "track_disdim": track_disdim}
-                elif track["type"] == "audio":
-                    if track_lang not in languages_audio:
-                        languages_audio.append(track_lang)
-                    if track_type not in types_audio:
-                        types_audio.append(track_type)
-                    files_Full[i][9][track_id] = {"track_type": track_type, "track_lang": track_lang, "track_name": track_name}
-                elif track["type"] == "subtitles":
-                    if "encoding" in track["properties"]:
-                        track_encode = track["properties"]["encoding"]
-                    else:
-                        track_encode = ""
-                    if track_lang not in languages_subtitle:
-                        languages_subtitle.append(track_lang)
-                    if track_type not in types_subtitle:
-                        types_subtitle.append(track_type)
-                    files_Full[i][10][track_id] = {"track_type": track_type, "track_lang": track_lang, "track_name": track_name, "track_encode": track_encode}
-                else:
-                    print("Unknown track type = " + str(file))
+        # Start from scratch, as this can be called again on data that has already been parsed
+        parsed = parse_tracks(files_Full[i][7])
+        files_Full[i][1] = parsed["title"]
+        files_Full[i][8] = parsed["video"]
+        files_Full[i][9] = parsed["audio"]
+        files_Full[i][10] = parsed["subtitles"]
+        files_Full[i][5] = get_layout_key(parsed)
+        files_Full[i][11] = [str(track_id) for track_id, kind in parsed["defaults"]]
+        # The audio/subtitle tracks for the data grid (rendered by render_cell, memoized), shared by all of the files with the same track layout
+        if files_Full[i][5] not in layout_tracks:
+            layout_tracks[files_Full[i][5]] = (get_track_tuples(parsed["audio"], files_Full[i][11]), get_track_tuples(parsed["subtitles"], files_Full[i][11]), render_defaults(tuple(parsed["defaults"])))
+        files_Full[i][2], files_Full[i][3], files_Full[i][4] = layout_tracks[files_Full[i][5]]
+        for track_id in parsed["audio"]:  # Populate the track IDs, languages and types for the audio tracks
+            if str(track_id) not in ids_audio:
+                ids_audio.append(str(track_id))
+            if parsed["audio"][track_id]["track_lang"] not in languages_audio:
+                languages_audio.append(parsed["audio"][track_id]["track_lang"])
+            if parsed["audio"][track_id]["track_type"] not in types_audio:
+                types_audio.append(parsed["audio"][track_id]["track_type"])
+        for track_id in parsed["subtitles"]:  # Populate the track IDs, languages and types for the subtitle tracks
+            if str(track_id) not in ids_subtitle:
+                ids_subtitle.append(str(track_id))
+            if parsed["subtitles"][track_id]["track_lang"] not in languages_subtitle:
+                languages_subtitle.append(parsed["subtitles"][track_id]["track_lang"])
+            if parsed["subtitles"][track_id]["track_type"] not in types_subtitle:
+                types_subtitle.append(parsed["subtitles"][track_id]["track_type"])
     # Sort the lists
     languages_audio.sort()
     languages_subtitle.sort()
@@ -751,71 +1844,6 @@ def parse_json_data():
     types_subtitle.sort()
     ids_audio.sort()
     ids_subtitle.sort()
-    # Parse the individual tracks to get the easy list of audio and subtitles
-    # files_Full[0] = Current_Name
-    # files_Full[1] = Title
-    # files_Full[2] = Audio
-    # files_Full[3] = Subtitles
-    # files_Full[4] = Defaults
-    if multi_lines == True:
-        multi_lines_string = "\n"
-    else:
-        multi_lines_string = ",  "
-    for i in range(len(files_Full)):
-        audio = ""
-        for track in files_Full[i][9]:
-            name = str(files_Full[i][9][track]["track_name"])
-            name = name.replace("&", "&amp;")
-            if name == "":
-                if len(audio) > 0:
-                    if str(track) in files_Full[i][11]:
-                        audio = audio + str(multi_lines_string) + "<b>" + str(track) + "-" + str(files_Full[i][9][track]["track_lang"]) + " (" + str(files_Full[i][9][track]["track_type"]) + ")</b>"
-                    else:
-                        audio = audio + str(multi_lines_string) + str(track) + "-" + str(files_Full[i][9][track]["track_lang"]) + " (" + str(files_Full[i][9][track]["track_type"]) + ")"
-                else:
-                    if str(track) in files_Full[i][11]:
-                        audio = audio + "<b>" + str(track) + "-" + str(files_Full[i][9][track]["track_lang"]) + " (" + str(files_Full[i][9][track]["track_type"]) + ")</b>"
-                    else:
-                        audio = audio + str(track) + "-" + str(files_Full[i][9][track]["track_lang"]) + " (" + str(files_Full[i][9][track]["track_type"]) + ")"
-            else:
-                if len(audio) > 0:
-                    if str(track) in files_Full[i][11]:
-                        audio = audio + str(multi_lines_string) + "<b>" + str(track) + "-" + str(files_Full[i][9][track]["track_lang"]) + " ('" + str(name) + "' " + str(files_Full[i][9][track]["track_type"]) + ")</b>"
-                    else:
-                        audio = audio + str(multi_lines_string) + str(track) + "-" + str(files_Full[i][9][track]["track_lang"]) + " ('" + str(name) + "' " + str(files_Full[i][9][track]["track_type"]) + ")"
-                else:
-                    if str(track) in files_Full[i][11]:
-                        audio = audio + "<b>" + str(track) + "-" + str(files_Full[i][9][track]["track_lang"]) + " ('" + str(name) + "' " + str(files_Full[i][9][track]["track_type"]) + ")</b>"
-                    else:
-                        audio = audio + str(track) + "-" + str(files_Full[i][9][track]["track_lang"]) + " ('" + str(name) + "' " + str(files_Full[i][9][track]["track_type"]) + ")"
-        files_Full[i][2] = audio
-        subtitles = ""
-        for track in files_Full[i][10]:
-            name = str(files_Full[i][10][track]["track_name"])
-            name = name.replace("&", "&amp;")
-            if name == "":
-                if len(subtitles) > 0:
-                    if str(track) in files_Full[i][11]:
-                        subtitles = subtitles + str(multi_lines_string) + "<b>" + str(track) + "-" + str(files_Full[i][10][track]["track_lang"]) + " (" + str(files_Full[i][10][track]["track_type"]) + ")</b>"
-                    else:
-                        subtitles = subtitles + str(multi_lines_string) + str(track) + "-" + str(files_Full[i][10][track]["track_lang"]) + " (" + str(files_Full[i][10][track]["track_type"]) + ")"
-                else:
-                    if str(track) in files_Full[i][11]:
-                        subtitles = subtitles + "<b>" + str(track) + "-" + str(files_Full[i][10][track]["track_lang"]) + " (" + str(files_Full[i][10][track]["track_type"]) + ")</b>"
-                    else:
-                        subtitles = subtitles + str(track) + "-" + str(files_Full[i][10][track]["track_lang"]) + " (" + str(files_Full[i][10][track]["track_type"]) + ")"
-            else:
-                if len(subtitles) > 0:
-                    if str(track) in files_Full[i][11]:
-                        subtitles = subtitles + str(multi_lines_string) + "<b>" + str(track) + "-" + str(files_Full[i][10][track]["track_lang"]) + " ('" + str(name) + "' " + str(files_Full[i][10][track]["track_type"]) + ")</b>"
-                    else:
-                        subtitles = subtitles + str(multi_lines_string) + str(track) + "-" + str(files_Full[i][10][track]["track_lang"]) + " ('" + str(name) + "' " + str(files_Full[i][10][track]["track_type"]) + ")"
-                else:
-                    if str(track) in files_Full[i][11]:
-                        subtitles = subtitles + "<b>" + str(track) + "-" + str(files_Full[i][10][track]["track_lang"]) + " ('" + str(name) + "' " + str(files_Full[i][10][track]["track_type"]) + ")</b>"
-                    else:
-                        subtitles = subtitles + str(track) + "-" + str(files_Full[i][10][track]["track_lang"]) + " ('" + str(name) + "' " + str(files_Full[i][10][track]["track_type"]) + ")"
-        files_Full[i][3] = subtitles
 
 
 def update_parameter_files_at_start(command_line_parameters):  # Fix and Validate the command lind parameter files list and add to parameter_files
@@ -864,15 +1892,49 @@ def update_parameter_files_at_start(command_line_parameters):  # Fix and Validat
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Bulk set the default audio & subtitle tracks of mkv files.")
+    parser.add_argument("paths", nargs="*", help="The folder (or files in a folder) to start with.")
+    parser.add_argument("--export-snapshot", metavar="SNAPSHOT", help="Scan the folder and write a snapshot (*.jsonl, *.jsonl.gz or *.jsonl.zst) without opening the GUI.")
+    parser.add_argument("--import-snapshot", metavar="SNAPSHOT", help="Open the GUI with a snapshot instead of scanning the folder.")
+    parser.add_argument("--profile", metavar="NAME", help="Evaluate a saved rule profile over every folder given and print the command lines (or --save-plan them), without opening the GUI.")
+    parser.add_argument("--save-plan", metavar="PLAN", help="Where to write the combined plan of --profile.")
+    parser.add_argument("--stream", action="store_true", help="Run --profile as a streaming pipeline (list, probe, parse, rule, plan, then print/--save-plan/--apply one file at a time), so memory use stays flat for whole libraries.  The folders are searched recursively, so a library root is enough.")
+    parser.add_argument("--apply", action="store_true", help="With --profile --stream:  apply (and verify) each file's plan straight away, writing the per file results to --results (required).")
+    parser.add_argument("--apply-plan", metavar="PLAN", help="Run the mkvpropedit commands of a plan file (saved from the Command Lines dialog) and verify the results, without opening the GUI.")
+    parser.add_argument("--results", metavar="RESULTS", help="Where to write the per file results of --apply-plan (*.jsonl).")
+    parser.add_argument("--write-manifest", metavar="MANIFEST", help="Write the folder's list of mkv files to a manifest, split into --shards shards.")
+    parser.add_argument("--shards", type=int, default=1, help="How many shards --write-manifest splits the files into.")
+    parser.add_argument("--manifest", metavar="MANIFEST", help="Only work on the files of a manifest:  either one --shard of it, or all of its shards using --workers local processes.")
+    parser.add_argument("--shard", type=int, help="Which shard (0 based) of the --manifest this node works on.")
+    parser.add_argument("--workers", type=int, help="Run every shard of the --manifest in its own local process (for testing) and merge the outputs.")
+    parser.add_argument("--merge", nargs="+", metavar=("MERGED", "SHARD"), help="Merge per shard snapshots or results back into one file, in the --manifest's order.")
+    parser.add_argument("--ionice", choices=["best-effort", "idle"], default="", help="The I/O priority class to apply the plans with (default:  normal).")
+    parser.add_argument("--nice", type=int, default=0, help="The CPU nice level (0-19) to apply the plans with.")
+    parser.add_argument("--rate-files", type=float, default=0.0, help="Apply at most this many files per second (default:  no limit).")
+    parser.add_argument("--rate-mb", type=float, default=0.0, help="Apply at most this many MB (written, i.e. of the edited headers) per second (default:  no limit).")
+    parser.add_argument("--max-processes", type=int, default=process_options["max_processes"], help="The most mkvmerge/mkvpropedit processes to run at the same time (default:  %(default)s).")
+    parser.add_argument("--timeout", type=float, default=process_options["timeout"], help="Give up on an mkvmerge/mkvpropedit call after this many seconds (default:  %(default)s).  Only reads (mkvmerge) are retried after a timeout.")
+    parser.add_argument("--retries", type=int, default=process_options["retries"], help="How many times to retry a call that timed out or hit a transient I/O error (default:  %(default)s).")
+    args = parser.parse_args()
+    process_options.update({"max_processes": args.max_processes, "timeout": args.timeout, "retries": args.retries})
+    apply_options.update({"ionice": args.ionice, "nice": args.nice, "rate_files": args.rate_files, "rate_mb": args.rate_mb})
+    if (args.stream or args.apply) and not args.profile:
+        parser.error("--stream and --apply are only used with --profile")
+    if args.apply and not (args.stream and args.results):
+        parser.error("--apply needs --stream and --results (where to write the per file results)")
+    if (args.merge or args.shard is not None or args.workers is not None) and not args.manifest:
+        parser.error("--merge, --shard and --workers are only used with --manifest")
+    if args.manifest and not (args.merge or args.export_snapshot or args.apply_plan):
+        parser.error("--manifest needs --export-snapshot, --apply-plan or --merge")
     # Check for command line arguments, and set the default_folder_path appropriately
-    if len(sys.argv) > 1:  # If there is a command line argument, check if it is a folder
-        if os.path.isdir(sys.argv[1]):  # Valid folder:  so set the default_folder_path to it
-            default_folder_path = sys.argv[1]
-        elif os.path.isdir(os.path.dirname(os.path.abspath(sys.argv[1]))):  # If valid file path was sent:  use folder path from it.
-            default_folder_path = os.path.dirname(os.path.abspath(sys.argv[1]))
-        elif "file://" in sys.argv[1]:  # In case using 'Bulk Rename' option in Nemo, get file path from first parameter and auto-select the files.
-            update_parameter_files_at_start(sys.argv[1:])  # Convert URL encoded files to paths
-            if os.path.isdir(os.path.dirname(os.path.abspath(parameter_files[0]))):  # If the first file is a valid path:  use folder path from it.
+    if len(args.paths) > 0:  # If there is a command line argument, check if it is a folder
+        if os.path.isdir(args.paths[0]):  # Valid folder:  so set the default_folder_path to it
+            default_folder_path = args.paths[0]
+        elif os.path.isdir(os.path.dirname(os.path.abspath(args.paths[0]))):  # If valid file path was sent:  use folder path from it.
+            default_folder_path = os.path.dirname(os.path.abspath(args.paths[0]))
+        elif "file://" in args.paths[0]:  # In case using 'Bulk Rename' option in Nemo, get file path from first parameter and auto-select the files.
+            update_parameter_files_at_start(args.paths)  # Convert URL encoded files to paths
+            if len(parameter_files) > 0 and os.path.isdir(os.path.dirname(os.path.abspath(parameter_files[0]))):  # If the first file is a valid path:  use folder path from it.
                 default_folder_path = os.path.dirname(os.path.abspath(parameter_files[0]))
             else:  # Invalid first file path:  so set the default_folder_path to where the python file is
                 default_folder_path = sys.path[0]
@@ -880,5 +1942,88 @@ if __name__ == '__main__':
             default_folder_path = sys.path[0]
     else:  # No command line argument:  so set the default_folder_path to where the python file is
         default_folder_path = sys.path[0]
+    if args.write_manifest:  # Headless:  list the folder's files, save them and quit
+        manifest = write_manifest(args.write_manifest, args.shards)
+        print("Wrote " + str(len(manifest["files"])) + " files in " + str(manifest["shards"]) + " shards to " + args.write_manifest)
+        sys.exit(0)
+    if args.profile:  # Headless:  evaluate a rule profile over all of the folders and quit
+        try:
+            profiles = load_profiles()
+        except (ValueError, OSError) as error:
+            print("Could not read " + profiles_path + ":  " + str(error))
+            sys.exit(1)
+        if args.profile not in profiles:
+            print("There is no saved profile called '" + args.profile + "' in " + profiles_path)
+            sys.exit(1)
+        folders = [path for path in args.paths if os.path.isdir(path)]
+        if len(folders) == 0:
+            folders = [default_folder_path]
+        if args.stream:
+            planned = stream_plans(folders, profiles[args.profile])
+            if args.apply:
+                write_jsonl(args.results, {"columns": result_columns}, summarize_results(stream_apply(planned)))
+            elif args.save_plan:
+                write_jsonl(args.save_plan, {"columns": plan_columns}, (get_plan_row(file_path, plan) for file_path, plan in planned))
+                print("Saved the plan to " + args.save_plan)
+            else:
+                for file_path, plan in planned:
+                    print("# " + file_path + get_impact_comment(plan))
+                    print(shlex.join(build_mkvpropedit_command(file_path, plan)))
+            sys.exit(0)
+        plan_profile_folders(profiles[args.profile], folders)
+        for line in format_impact(estimate_impact(list(plans.keys()))):
+            print("# " + line)
+        if args.save_plan:
+            save_plan(args.save_plan)
+            print("Saved the plan for " + str(len(plans)) + " files from " + str(len(folders)) + " folders to " + args.save_plan)
+        else:
+            for file_path in plans:
+                print("# " + file_path + get_impact_comment(plans[file_path]))
+                print(shlex.join(build_mkvpropedit_command(file_path, plans[file_path])))
+        sys.exit(0)
+    if args.manifest and (args.export_snapshot or args.apply_plan):
+        if (args.shard is None) == (args.workers is None):
+            parser.error("--manifest needs either --shard (this node's shard) or --workers (all of the shards locally)")
+        if args.shard is not None and not 0 <= args.shard < read_manifest(args.manifest)["shards"]:
+            parser.error("--shard must be between 0 and " + str(read_manifest(args.manifest)["shards"] - 1) + " for this --manifest")
+    if args.apply_plan and not args.results:
+        if args.manifest and args.shard is not None:  # Every node writes its own results, see --merge
+            args.results = args.apply_plan + ".results.shard" + str(args.shard) + ".jsonl"
+        else:
+            args.results = args.apply_plan + ".results.jsonl"
+    if args.merge and len(args.merge) < 2:
+        parser.error("--merge needs the merged file and at least one shard file")
+    if args.manifest and args.merge:  # Headless:  merge the shards' output files and quit
+        merged_header, merged_rows = merge_shards(args.manifest, args.merge[1:], args.merge[0])
+        if "returncode" in merged_header["columns"]:
+            print_results_summary(merged_rows)
+        print("Merged " + str(len(args.merge) - 1) + " shards into " + args.merge[0])
+        sys.exit(0)
+    if args.manifest and (args.export_snapshot or args.apply_plan):  # Headless:  work on one or all of the manifest's shards and quit
+        if args.workers:
+            run_shards_locally(args.manifest, args.workers, args.export_snapshot, args.apply_plan, args.results)
+        else:
+            run_shard(args.manifest, args.shard, args.export_snapshot, args.apply_plan, args.results)
+        if args.export_snapshot:
+            print("Exported the scanned files to " + args.export_snapshot)
+        if args.apply_plan:
+            header, rows = read_jsonl(args.results)
+            print_results_summary(rows)
+        sys.exit(0)
+    if args.apply_plan:  # Headless:  apply the whole plan and quit
+        load_plan(args.apply_plan)
+        for line in format_impact(estimate_impact(list(plans.keys()))):
+            print("# " + line)
+        results = apply_plans(order_for_locality(list(plans.keys())))
+        write_jsonl(args.results, {"columns": result_columns}, results)
+        print_results_summary(results)
+        sys.exit(0)
+    if args.export_snapshot:  # Headless:  scan the folder, save it and quit
+        populate_files_Full()
+        export_snapshot(args.export_snapshot)
+        print("Exported " + str(len(files_Full)) + " files from " + default_folder_path + " to " + args.export_snapshot)
+        sys.exit(0)
     main = Main()
+    if args.import_snapshot:
+        main.load_snapshot(args.import_snapshot)
     gtk.main()